@@ -1,5 +1,8 @@
+import heapq
+from array import array
 from dataclasses import dataclass
-from typing import List, Dict, Any
+from itertools import product
+from typing import Any, Callable, Dict, List, Tuple
 
 
 @dataclass(frozen=True)
@@ -85,54 +88,122 @@ KITS: List[DrumKit] = [
 ]
 
 
-def score_kit(kit: DrumKit, prefs: Dict[str, Any]) -> int:
-    score = 0
+def _clip(text: str, limit: int) -> str:
+    return text if len(text) <= limit else text[: limit - 1].rstrip() + "…"
 
+
+# Prompt line for each kit, keyed by id. Kits are immutable, so these are
+# formatted once instead of on every request.
+SHORTLIST_LINES: Dict[str, str] = {
+    k.id: (
+        f"- {k.name} | {k.kit_type} | ${k.price_min}-${k.price_max} | "
+        f"space:{k.space} | skill:{k.skill} | notes:{_clip(k.notes, 80)}"
+    )
+    for k in KITS
+}
+
+
+# Small int codes for the categorical fields, so scoring compares ints
+# rather than strings. Unknown preference values encode as -1.
+KIT_TYPE: Dict[str, int] = {"acoustic": 0, "electronic": 1}
+SPACE: Dict[str, int] = {"apartment": 0, "house": 1, "studio": 2}
+SKILL: Dict[str, int] = {"beginner": 0, "intermediate": 1, "advanced": 2}
+
+_ACOUSTIC = KIT_TYPE["acoustic"]
+_ELECTRONIC = KIT_TYPE["electronic"]
+_APARTMENT = SPACE["apartment"]
+_BEGINNER = SKILL["beginner"]
+_ADVANCED = SKILL["advanced"]
+
+# Struct-of-arrays view of KITS, built once at import so scoring reads
+# flat columns instead of dataclass attributes.
+_TYPE_CODES = array("b", [KIT_TYPE[k.kit_type] for k in KITS])
+_PRICE_MIN = array("i", [k.price_min for k in KITS])
+_PRICE_MAX = array("i", [k.price_max for k in KITS])
+_SPACE_CODES = array("b", [SPACE[k.space] for k in KITS])
+_SKILL_CODES = array("b", [SKILL[k.skill] for k in KITS])
+_GENRES: List[frozenset] = [frozenset(k.genres) for k in KITS]
+
+
+def encode_prefs(prefs: Dict[str, Any]) -> Tuple[int, int, int, int, str, bool]:
+    return (
+        KIT_TYPE.get(prefs["kit_type"], -1),
+        prefs["budget"],
+        SPACE.get(prefs["space"], -1),
+        SKILL.get(prefs["skill"], -1),
+        prefs["genre"],
+        bool(prefs["quiet_priority"]),
+    )
+
+
+def _categorical_score(
+    p_type: int,
+    p_space: int,
+    p_skill: int,
+    quiet: bool,
+    kit_type: int,
+    space: int,
+    skill: int,
+) -> int:
     # Type
-    if prefs["kit_type"] == kit.kit_type:
-        score += 30
-    else:
-        score -= 10
-
-    # Budget overlap (hard-ish constraint)
-    budget = prefs["budget"]
-    if kit.price_min <= budget <= kit.price_max:
-        score += 25
-    elif budget < kit.price_min:
-        score -= 20
-    else:
-        score -= 5
+    score = 30 if p_type == kit_type else -10
 
     # Space / noise reality
-    if prefs["space"] == kit.space:
-        score += 20
-    elif prefs["space"] == "apartment" and kit.kit_type == "acoustic":
-        score -= 40  # be honest: acoustic + apartment is a conflict
-    else:
-        score += 5
+    # be honest: acoustic + apartment is a conflict
+    space_match = p_space == space
+    conflict = not space_match and p_space == _APARTMENT and kit_type == _ACOUSTIC
+    score += 20 * space_match - 40 * conflict + 5 * (not space_match and not conflict)
 
     # Skill match
-    if prefs["skill"] == kit.skill:
-        score += 10
-    elif prefs["skill"] == "beginner" and kit.skill != "advanced":
-        score += 6
-    else:
-        score += 0
-
-    # Genre match
-    genre = prefs["genre"]
-    if genre in kit.genres:
-        score += 15
-    else:
-        score += 2
+    skill_match = p_skill == skill
+    score += 10 * skill_match + 6 * (
+        not skill_match and p_skill == _BEGINNER and skill != _ADVANCED
+    )
 
     # Practice priority (quiet)
-    if prefs["quiet_priority"] and kit.kit_type == "electronic":
-        score += 10
+    score += 10 * (quiet and kit_type == _ELECTRONIC)
+
+    return score
+
+
+# The type/space/skill/quiet part of the score only depends on a handful of
+# categorical prefs, so every combination (unknowns included) is scored for
+# every kit ahead of time. Requests then only add the budget and genre terms.
+_BASE_SCORES: Dict[Tuple[int, int, int, bool], array] = {
+    (p_type, p_space, p_skill, quiet): array(
+        "i",
+        [
+            _categorical_score(p_type, p_space, p_skill, quiet, *codes)
+            for codes in zip(_TYPE_CODES, _SPACE_CODES, _SKILL_CODES)
+        ],
+    )
+    for p_type, p_space, p_skill, quiet in product(
+        (-1, *KIT_TYPE.values()),
+        (-1, *SPACE.values()),
+        (-1, *SKILL.values()),
+        (False, True),
+    )
+}
+
+
+def make_scorer(prefs: Dict[str, Any]) -> Callable[[int], int]:
+    """Return a scorer for kit indices with ``prefs`` already baked in."""
+    p_type, budget, p_space, p_skill, genre, quiet = encode_prefs(prefs)
+    base = _BASE_SCORES[p_type, p_space, p_skill, quiet]
+
+    def score(i: int) -> int:
+        # Budget overlap (hard-ish constraint)
+        price_min = _PRICE_MIN[i]
+        in_range = price_min <= budget <= _PRICE_MAX[i]
+        below = budget < price_min
+        s = base[i] + 25 * in_range - 20 * below - 5 * (not in_range and not below)
+
+        # Genre match
+        return s + (15 if genre in _GENRES[i] else 2)
 
     return score
 
 
 def pick_top_kits(prefs: Dict[str, Any], k: int = 3) -> List[DrumKit]:
-    ranked = sorted(KITS, key=lambda kit: score_kit(kit, prefs), reverse=True)
-    return ranked[:k]
+    top = heapq.nlargest(k, range(len(KITS)), key=make_scorer(prefs))
+    return [KITS[i] for i in top]
@@ -1,16 +1,22 @@
+import html
 import os
-from typing import Any, Dict, List
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, List, Tuple
+from urllib.parse import urlencode
 
 import httpx
-from fastapi import FastAPI, Form
-from fastapi.responses import HTMLResponse
+import orjson
+from fastapi import FastAPI, Form, Query
+from fastapi.middleware.gzip import GZipMiddleware
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
 
-from kits import pick_top_kits, DrumKit
+from kits import pick_top_kits, DrumKit, SHORTLIST_LINES
 
 DO_INFERENCE_BASE_URL = "https://inference.do-ai.run"
 
-app = FastAPI(title="Drum Kit Picker")
-
 
 def env_required(name: str) -> str:
     val = os.getenv(name)
@@ -19,30 +25,137 @@ def env_required(name: str) -> str:
     return val
 
 
-async def do_chat(model: str, api_key: str, messages: List[Dict[str, Any]]) -> str:
-    url = f"{DO_INFERENCE_BASE_URL}/v1/chat/completions"
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-    }
-    payload = {
-        "model": model,
-        "messages": messages,
-        "temperature": 0.4,
-        "max_tokens": 500,
-    }
+MODEL_ACCESS_KEY = env_required("DO_MODEL_ACCESS_KEY")
+MODEL_ID = os.getenv("DO_MODEL_ID", "llama3.3-70b-instruct")
+MAX_OUTPUT_TOKENS = int(os.getenv("DO_MAX_OUTPUT_TOKENS", "300"))
+
+# Everything but the messages is fixed for the process lifetime.
+HEADERS = {
+    "Authorization": f"Bearer {MODEL_ACCESS_KEY}",
+    "Content-Type": "application/json",
+}
+PAYLOAD_TEMPLATE: Dict[str, Any] = {
+    "model": MODEL_ID,
+    "temperature": 0.2,
+    "max_tokens": MAX_OUTPUT_TOKENS,
+    "stream": True,
+}
+
+# Upper bound on simultaneous connections to the inference endpoint. Concurrent
+# /commentary requests share the pool and are never serialized on a lock.
+MAX_CONCURRENCY = int(os.getenv("DO_MAX_CONCURRENCY", "100"))
+
+# Shared HTTP/2 client so requests to the inference endpoint are multiplexed
+# over a reused connection instead of paying a TCP + TLS handshake every time.
+client: httpx.AsyncClient | None = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global client
+    client = httpx.AsyncClient(
+        base_url=DO_INFERENCE_BASE_URL,
+        headers=HEADERS,
+        timeout=30,
+        http2=True,
+        limits=httpx.Limits(
+            max_keepalive_connections=min(50, MAX_CONCURRENCY),
+            max_connections=MAX_CONCURRENCY,
+        ),
+    )
+    # Open the connection before the first user needs it. Any response will
+    # do; failures just mean the first request pays the handshake instead.
+    try:
+        await client.head("/", timeout=5)
+    except httpx.HTTPError:
+        pass
+    try:
+        yield
+    finally:
+        await client.aclose()
+        client = None
+
+
+class PageGZipMiddleware(GZipMiddleware):
+    """GZip responses except the commentary stream.
 
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.post(url, headers=headers, json=payload)
+    GZip buffers small writes, which would hold back the streamed commentary
+    instead of flushing each delta to the browser.
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and scope["path"] == "/commentary":
+            await self.app(scope, receive, send)
+            return
+        await super().__call__(scope, receive, send)
+
+
+app = FastAPI(title="Drum Kit Picker", lifespan=lifespan)
+app.add_middleware(PageGZipMiddleware, minimum_size=500)
+
+
+def parse_sse_delta(line: str) -> str:
+    """Return the text delta carried by one SSE line, or "" if there is none."""
+    if not line.startswith("data:"):
+        return ""
+    data = line[5:].strip()
+    if not data or data == "[DONE]":
+        return ""
+    choices = orjson.loads(data).get("choices") or []
+    if not choices:
+        return ""
+    return choices[0].get("delta", {}).get("content") or ""
+
+
+async def do_chat(messages: List[Dict[str, Any]]) -> AsyncIterator[str]:
+    payload = {**PAYLOAD_TEMPLATE, "messages": messages}
+
+    async with client.stream(
+        "POST", "/v1/chat/completions", content=orjson.dumps(payload)
+    ) as r:
         r.raise_for_status()
-        data = r.json()
+        async for line in r.aiter_lines():
+            delta = parse_sse_delta(line)
+            if delta:
+                yield delta
 
-    return data["choices"][0]["message"]["content"]
 
+# In-process cache of finished recommendations. Preferences are a small
+# categorical product, so popular combinations repeat often. Entries expire so
+# a model upgrade is picked up within a day.
+REC_CACHE_TTL = 24 * 60 * 60
+REC_CACHE_SIZE = 1024
+_rec_cache: "OrderedDict[Tuple[Any, ...], Tuple[float, str]]" = OrderedDict()
 
-@app.get("/", response_class=HTMLResponse)
-async def home():
-    return """
+
+def budget_bucket(budget: int) -> int:
+    return (budget + 50) // 100 * 100
+
+
+async def cached_chat(
+    key: Tuple[Any, ...], messages: List[Dict[str, Any]]
+) -> AsyncIterator[str]:
+    hit = _rec_cache.get(key)
+    if hit is not None and hit[0] > time.monotonic():
+        _rec_cache.move_to_end(key)
+        yield hit[1]
+        return
+
+    parts = []
+    async for delta in do_chat(messages):
+        parts.append(delta)
+        yield delta
+
+    # Only complete responses are cached; a failed stream raises before here.
+    _rec_cache[key] = (time.monotonic() + REC_CACHE_TTL, "".join(parts))
+    _rec_cache.move_to_end(key)
+    while len(_rec_cache) > REC_CACHE_SIZE:
+        _rec_cache.popitem(last=False)
+
+
+# Page bodies are encoded once at import so responses skip per-request
+# string building and UTF-8 encoding.
+HOME_HTML = """
 <!doctype html>
 <html>
 <head>
@@ -97,99 +210,191 @@ async def home():
   </form>
 </body>
 </html>
-"""
+""".encode()
 
 
-@app.post("/recommend", response_class=HTMLResponse)
-async def recommend(
-    kit_type: str = Form(...),
-    budget: int = Form(...),
-    space: str = Form(...),
-    skill: str = Form(...),
-    genre: str = Form(...),
-    quiet_priority: str = Form(...),
-) -> str:
-    prefs = {
-        "kit_type": kit_type,
-        "budget": int(budget),
-        "space": space,
-        "skill": skill,
-        "genre": genre,
-        "quiet_priority": quiet_priority == "yes",
-    }
-
-    # Deterministic shortlist
-    top = pick_top_kits(prefs, k=3)
-
-    model_access_key = env_required("DO_MODEL_ACCESS_KEY")
-    model_id = os.getenv("DO_MODEL_ID", "llama3.3-70b-instruct")
-
-    shortlist_text = "\n".join(
-        [
-            f"- {k.name} | {k.kit_type} | ${k.price_min}-${k.price_max} | "
-            f"space:{k.space} | skill:{k.skill} | notes:{k.notes}"
-            for k in top
-        ]
-    )
-
-    system = (
-        "You recommend drum kits. "
-        "Use ONLY the provided shortlist. "
-        "Be direct and practical. "
-        "Return sections: Best pick, Runner-up, Third option, What to buy, Setup tips."
-    )
+@app.get("/", response_class=HTMLResponse)
+async def home() -> Response:
+    return Response(content=HOME_HTML, media_type="text/html")
 
-    user = (
-        f"User preferences:\n"
-        f"- type: {prefs['kit_type']}\n"
-        f"- budget: ${prefs['budget']}\n"
-        f"- space: {prefs['space']}\n"
-        f"- skill: {prefs['skill']}\n"
-        f"- genre: {prefs['genre']}\n"
-        f"- quiet priority: {prefs['quiet_priority']}\n\n"
-        f"Shortlist:\n{shortlist_text}"
-    )
 
-    try:
-        rec = await do_chat(
-            model=model_id,
-            api_key=model_access_key,
-            messages=[
-                {"role": "system", "content": system},
-                {"role": "user", "content": user},
-            ],
-        )
-    except Exception as e:
-        rec = f"AI call failed: {type(e).__name__}: {e}"
-
-    return f"""
+RECOMMEND_HEAD = """
 <!doctype html>
 <html>
 <head>
   <meta charset="utf-8"/>
   <title>Recommendations</title>
   <style>
-    body {{
+    body {
       font-family: system-ui, -apple-system, Segoe UI, Roboto, sans-serif;
       margin: 2rem;
       max-width: 860px;
-    }}
-    pre {{
+    }
+    pre {
       white-space: pre-wrap;
       background: #f6f6f6;
       padding: 1rem;
       border-radius: 12px;
-    }}
-    a {{
+    }
+    a {
       display: inline-block;
       margin-top: 1rem;
-    }}
+    }
   </style>
 </head>
 <body>
   <h1>Your recommendations</h1>
-  <pre>{rec}</pre>
+""".encode()
+
+# The commentary is fetched after the shortlist has rendered and appended to
+# the <pre> as it streams in.
+RECOMMEND_TAIL = """
   <a href="/">← Back</a>
+  <script>
+    (async () => {
+      const out = document.getElementById("rec");
+      try {
+        const r = await fetch(out.dataset.src);
+        if (!r.ok) throw new Error(r.status + " " + r.statusText);
+        const reader = r.body.getReader();
+        const decoder = new TextDecoder();
+        out.textContent = "";
+        for (;;) {
+          const { done, value } = await reader.read();
+          if (done) break;
+          out.textContent += decoder.decode(value, { stream: true });
+        }
+      } catch (e) {
+        out.textContent = "AI call failed: " + e;
+      }
+    })();
+  </script>
 </body>
 </html>
-"""
+""".encode()
+
+
+# Kept byte-identical across requests so the inference server can reuse its
+# prefix cache for it.
+SYSTEM_PROMPT = (
+    "You recommend drum kits. "
+    "Use ONLY the provided shortlist. "
+    "Be direct and practical. "
+    "Return sections: Best pick, Runner-up, Third option, What to buy, Setup tips."
+)
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+
+def build_prefs(
+    kit_type: str,
+    budget: int,
+    space: str,
+    skill: str,
+    genre: str,
+    quiet_priority: str,
+) -> Dict[str, Any]:
+    return {
+        "kit_type": kit_type,
+        "budget": budget,
+        "space": space,
+        "skill": skill,
+        "genre": genre,
+        "quiet_priority": quiet_priority == "yes",
+    }
+
+
+def build_messages(
+    prefs: Dict[str, Any], top: List[DrumKit]
+) -> List[Dict[str, Any]]:
+    shortlist_text = "\n".join(SHORTLIST_LINES[k.id] for k in top)
+
+    user = (
+        f"Prefs: type={prefs['kit_type']},budget={budget_bucket(prefs['budget'])},"
+        f"space={prefs['space']},skill={prefs['skill']},genre={prefs['genre']},"
+        f"quiet={int(prefs['quiet_priority'])}\n"
+        f"Shortlist:\n{shortlist_text}"
+    )
+
+    return [
+        SYSTEM_MESSAGE,
+        {"role": "user", "content": user},
+    ]
+
+
+@app.post("/recommend", response_class=HTMLResponse)
+async def recommend(
+    kit_type: str = Form(...),
+    budget: int = Form(...),
+    space: str = Form(...),
+    skill: str = Form(...),
+    genre: str = Form(...),
+    quiet_priority: str = Form(...),
+) -> Response:
+    prefs = build_prefs(kit_type, budget, space, skill, genre, quiet_priority)
+
+    # Deterministic shortlist, rendered straight away. The LLM commentary is
+    # fetched separately so it never holds up the first paint.
+    top = pick_top_kits(prefs, k=3)
+
+    items = "\n".join(
+        f"    <li>{html.escape(k.name)} ({k.kit_type}, "
+        f"${k.price_min}-${k.price_max})</li>"
+        for k in top
+    )
+    query = urlencode(
+        {
+            "kit_type": kit_type,
+            "budget": budget,
+            "space": space,
+            "skill": skill,
+            "genre": genre,
+            "quiet_priority": quiet_priority,
+        }
+    )
+    body = (
+        f"  <ol>\n{items}\n  </ol>\n"
+        f'  <pre id="rec" data-src="/commentary?{html.escape(query)}">Thinking…</pre>'
+    )
+
+    return Response(
+        content=RECOMMEND_HEAD + body.encode() + RECOMMEND_TAIL,
+        media_type="text/html",
+    )
+
+
+@app.get("/commentary")
+async def commentary(
+    kit_type: str = Query(...),
+    budget: int = Query(...),
+    space: str = Query(...),
+    skill: str = Query(...),
+    genre: str = Query(...),
+    quiet_priority: str = Query(...),
+) -> StreamingResponse:
+    prefs = build_prefs(kit_type, budget, space, skill, genre, quiet_priority)
+
+    async def text() -> AsyncIterator[str]:
+        # Everything past the query validation runs under the guard, so any
+        # failure reaches the page as text rather than a bare 500.
+        try:
+            top = pick_top_kits(prefs, k=3)
+            messages = build_messages(prefs, top)
+
+            # Keyed on the same bucketed budget the prompt uses, so a cached
+            # answer was written for exactly this prompt.
+            cache_key = (
+                prefs["kit_type"],
+                budget_bucket(prefs["budget"]),
+                prefs["space"],
+                prefs["skill"],
+                prefs["genre"],
+                prefs["quiet_priority"],
+                tuple(k.id for k in top),
+            )
+
+            async for delta in cached_chat(cache_key, messages):
+                yield delta
+        except Exception as e:
+            yield f"AI call failed: {type(e).__name__}: {e}"
+
+    return StreamingResponse(text(), media_type="text/plain")